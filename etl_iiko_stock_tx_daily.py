@@ -1,10 +1,31 @@
 import os
+import json
+import queue
+import struct
+import threading
 import datetime as dt
+from collections import namedtuple
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import chain, islice
+from operator import itemgetter
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import psycopg2
-from psycopg2.extras import execute_values
+from psycopg2.extensions import encodings
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:  # без колеса orjson работаем на stdlib json (через resp.json())
+    orjson = None
+
+try:
+    import ijson
+except ImportError:  # нужен только для LOW_MEMORY=1
+    ijson = None
+
 load_dotenv()
 
 # ========== iiko ==========
@@ -12,8 +33,9 @@ IIKO_BASE_URL = (os.getenv("IIKO_BASE_URL", "") or "").strip().rstrip("/")
 IIKO_LOGIN = os.getenv("IIKO_LOGIN")
 IIKO_PASSWORD = os.getenv("IIKO_PASSWORD")
 
-DEPARTMENTS = ["Авиагородок", "Домодедово"]
-PRODUCT_NUM_FILTER = [
+DEPARTMENTS = ("Авиагородок", "Домодедово")
+# frozenset: O(1) проверка на клиенте; в тело OLAP уходит отсортированным списком
+PRODUCT_NUM_FILTER = frozenset({
     "0722",
     "45700042712",
     "45700042362",
@@ -39,7 +61,68 @@ PRODUCT_NUM_FILTER = [
     "00001",
     "00002",
     "00003",
-]  # если не нужен — сделай []
+})  # если не нужен — сделай frozenset()
+
+AMOUNT_FIELD = "Amount.StoreInOutTyped"
+
+# LOW_MEMORY=1 — потоковый разбор OLAP через ijson: меньше пик памяти, но медленнее orjson
+LOW_MEMORY = os.getenv("LOW_MEMORY") == "1"
+
+# ETL_VERBOSE=1 — печатать первые 10 строк из iiko по каждой части (отладка, в обычном запуске не нужно)
+VERBOSE = bool(os.getenv("ETL_VERBOSE"))
+
+# ETL_PRINT_SAMPLE=1 (или ETL_VERBOSE) — после загрузки вывести 10 строк из БД за период
+PRINT_DB_SAMPLE = os.getenv("ETL_PRINT_SAMPLE") == "1" or VERBOSE
+
+# STOCK_TX_SAMPLE_INDEX=1 — разово построить покрывающий индекс под выборку-образец (CREATE INDEX CONCURRENTLY
+# на боевой stock_tx_iiko). Индекс остаётся и удорожает каждый upsert, поэтому отладочные флаги его не создают
+ENSURE_SAMPLE_INDEX = os.getenv("STOCK_TX_SAMPLE_INDEX") == "1"
+
+# Сколько OLAP-запросов (по подразделениям) держим одновременно
+OLAP_CONCURRENCY = int(os.getenv("OLAP_CONCURRENCY", "2"))
+
+# (connect, read): мёртвый TCP-handshake отваливается за 5 секунд, а не ждёт весь read-таймаут
+IIKO_CONNECT_TIMEOUT = 5
+IIKO_TIMEOUT = (IIKO_CONNECT_TIMEOUT, 90)
+
+# Потолок одновременных запросов к iiko на весь процесс (сколько бы потоков ни запустили сверху)
+IIKO_SEM = threading.BoundedSemaphore(int(os.getenv("IIKO_MAX_CONCURRENCY", "4")))
+
+
+def _accept_encoding() -> str:
+    # br просим только если urllib3 сможет его распаковать (нужен пакет brotli / brotlicffi)
+    try:
+        import brotli  # noqa: F401
+    except ImportError:
+        try:
+            import brotlicffi  # noqa: F401
+        except ImportError:
+            return "gzip, deflate"
+    return "gzip, deflate, br"
+
+
+# Одна keep-alive сессия на весь запуск: auth / OLAP / logout идут по одному TCP+TLS соединению
+# Retry и на POST: OLAP-отчёт и logout идемпотентны, повтор на 502/503/504 безопасен
+_SESSION = requests.Session()
+_HTTP_ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(["GET", "POST"]),
+    ),
+)
+_SESSION.mount("https://", _HTTP_ADAPTER)
+_SESSION.mount("http://", _HTTP_ADAPTER)
+_SESSION.headers.update({"Connection": "keep-alive", "Accept-Encoding": _accept_encoding()})
+
+
+def _iiko_request(method: str, url: str, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", IIKO_TIMEOUT)
+    with IIKO_SEM:
+        return _SESSION.request(method, url, **kwargs)
 
 
 # ---------- helpers for iiko urls ----------
@@ -60,26 +143,108 @@ def iiko_api_url(path: str, use_resto: bool) -> str:
     return _join(base, path)
 
 
+# URL'ы используемых эндпоинтов считаем один раз: path -> (BASE/<path>, BASE/resto/<path>)
+IIKO_URLS = {
+    p: (iiko_api_url(p, use_resto=False), iiko_api_url(p, use_resto=True))
+    for p in ("/api/auth", "/api/logout", "/api/v2/reports/olap")
+}
+
+
+# Какой префикс сработал (False -> BASE/<path>, True -> BASE/resto/<path>), None — ещё не знаем.
+# Кэшируем на процесс и в файле рядом со скриптом, чтобы не платить за 404 на каждом вызове.
+IIKO_PREFIX_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".iiko_prefix_cache")
+
+
+def _load_resto_mode():
+    try:
+        with open(IIKO_PREFIX_CACHE_FILE, encoding="utf-8") as f:
+            base_url, _, mode = f.read().strip().rpartition("\t")
+    except OSError:
+        return None
+    # кэш валиден только для того же IIKO_BASE_URL
+    if base_url != IIKO_BASE_URL or mode not in ("0", "1"):
+        return None
+    return mode == "1"
+
+
+def _save_resto_mode(use_resto: bool):
+    try:
+        with open(IIKO_PREFIX_CACHE_FILE, "w", encoding="utf-8") as f:
+            f.write(f"{IIKO_BASE_URL}\t{int(use_resto)}\n")
+    except OSError as e:
+        print("⚠️ Не удалось сохранить кэш префикса iiko:", e)
+
+
+_RESTO_MODE = _load_resto_mode()
+
+
 def request_with_resto_fallback(method: str, path: str, **kwargs):
     """
     Сначала пробуем BASE/<path>, если 404 — пробуем BASE/resto/<path>.
+    Сработавший вариант запоминаем (_RESTO_MODE) и дальше ходим сразу туда — один запрос вместо двух.
+    Запись в _RESTO_MODE из параллельных потоков безопасна: все пишут одно и то же значение.
     """
+    global _RESTO_MODE
+
     if not IIKO_BASE_URL:
         raise RuntimeError("IIKO_BASE_URL is not set")
 
-    url1 = iiko_api_url(path, use_resto=False)
-    resp = requests.request(method, url1, **kwargs)
+    urls = IIKO_URLS.get(path)
+    if urls is None:
+        urls = (iiko_api_url(path, use_resto=False), iiko_api_url(path, use_resto=True))
+    url1, url2 = urls
+
+    if _RESTO_MODE is not None:
+        url, other_url = (url2, url1) if _RESTO_MODE else (url1, url2)
+        resp = _iiko_request(method, url, **kwargs)
+        if resp.status_code != 404:
+            return resp, url
+        # при stream=True тело 404 не дочитано — без close() соединение не вернётся в пул сессии
+        resp.close()
+
+        # кэш устарел (например, из файла от прошлой установки) — пробуем второй вариант и перезапоминаем
+        resp2 = _iiko_request(method, other_url, **kwargs)
+        if resp2.ok:
+            _RESTO_MODE = not _RESTO_MODE
+            _save_resto_mode(_RESTO_MODE)
+        return resp2, other_url
+
+    resp = _iiko_request(method, url1, **kwargs)
 
     if resp.status_code == 404:
-        url2 = iiko_api_url(path, use_resto=True)
-        resp2 = requests.request(method, url2, **kwargs)
+        resp.close()
+        resp2 = _iiko_request(method, url2, **kwargs)
+        if resp2.ok:
+            _RESTO_MODE = True
+            _save_resto_mode(True)
         return resp2, url2
 
+    if resp.ok:
+        _RESTO_MODE = False
+        _save_resto_mode(False)
     return resp, url1
 
 
+def dump_json(obj) -> bytes:
+    """Тело запроса сразу в bytes: orjson сериализует быстрее stdlib и без лишнего прохода внутри requests."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def parse_json(resp):
+    """orjson парсит bytes напрямую — без декодирования в str и заметно быстрее stdlib json."""
+    if orjson is not None:
+        return orjson.loads(resp.content)
+    return resp.json()
+
+
 # ========== Postgres (Neon) ==========
+# Для частых запусков PG_HOST лучше указывать на pooler-эндпоинт Neon (ep-xxx-pooler....neon.tech):
+# PgBouncer держит тёплые серверные соединения, и запуск не платит за их холодный старт.
 def get_pg_connection():
+    # id() нового соединения может совпасть со старым — кэш схемы сбрасываем
+    _COL_CACHE.clear()
     return psycopg2.connect(
         host=os.getenv("PG_HOST"),
         port=os.getenv("PG_PORT"),
@@ -87,6 +252,12 @@ def get_pg_connection():
         user=os.getenv("PG_USER"),
         password=os.getenv("PG_PASSWORD"),
         sslmode=os.getenv("PG_SSLMODE", "require"),
+        application_name=os.getenv("PG_APPLICATION_NAME", "iiko-etl-stocktx"),
+        # TCP keepalive: соединение не отваливается молча, пока ждём iiko / долгий пересчёт витрины
+        keepalives=1,
+        keepalives_idle=30,
+        keepalives_interval=10,
+        keepalives_count=3,
     )
 
 
@@ -120,7 +291,7 @@ def get_token() -> str:
         "GET",
         "/api/auth",
         params={"login": IIKO_LOGIN, "pass": IIKO_PASSWORD},
-        timeout=30,
+        timeout=(IIKO_CONNECT_TIMEOUT, 30),
     )
     print(f"🌐 AUTH URL: {used_url}")
     resp.raise_for_status()
@@ -138,7 +309,7 @@ def logout(token: str):
             "POST",
             "/api/logout",
             params={"key": token},
-            timeout=10,
+            timeout=(IIKO_CONNECT_TIMEOUT, 10),
         )
         print(f"🌐 LOGOUT URL: {used_url} ({resp.status_code})")
     except Exception as e:
@@ -146,9 +317,7 @@ def logout(token: str):
 
 
 # ========== iiko OLAP ==========
-def fetch_stock_tx(token: str, date_from: dt.date, date_to: dt.date):
-    print("📦 Загружаем OLAP 'Отчет по проводкам' из iiko...")
-
+def build_stock_tx_body(date_from: dt.date, date_to: dt.date, departments) -> dict:
     filters = {
         "DateTime.OperDayFilter": {
             "filterType": "DateRange",
@@ -160,17 +329,17 @@ def fetch_stock_tx(token: str, date_from: dt.date, date_to: dt.date):
         },
         "Department": {
             "filterType": "IncludeValues",
-            "values": DEPARTMENTS,
+            "values": list(departments),
         },
     }
 
     if PRODUCT_NUM_FILTER:
         filters["Product.Num"] = {
             "filterType": "IncludeValues",
-            "values": PRODUCT_NUM_FILTER,
+            "values": sorted(PRODUCT_NUM_FILTER),
         }
 
-    body = {
+    return {
         "reportType": "TRANSACTIONS",
         "groupByRowFields": [
             "DateTime.DateTyped",
@@ -182,50 +351,184 @@ def fetch_stock_tx(token: str, date_from: dt.date, date_to: dt.date):
             "Document",
             "TransactionType",
         ],
-        "aggregateFields": ["Amount.StoreInOutTyped"],
+        "aggregateFields": [AMOUNT_FIELD],
         "filters": filters,
     }
 
+
+def fetch_stock_tx_part(token: str, date_from: dt.date, date_to: dt.date, departments):
+    """
+    Один OLAP-запрос по списку подразделений -> сырые строки data[].
+    При LOW_MEMORY=1 — ленивый итератор ijson по потоку ответа (документ целиком в памяти не держим).
+    """
     resp, used_url = request_with_resto_fallback(
         "POST",
         "/api/v2/reports/olap",
         params={"key": token},
-        json=body,
-        timeout=90,
+        data=dump_json(build_stock_tx_body(date_from, date_to, departments)),
+        headers={"Content-Type": "application/json"},
+        timeout=IIKO_TIMEOUT,
+        stream=LOW_MEMORY,
     )
-    print(f"🌐 OLAP URL: {used_url}")
+    label = ", ".join(departments)
+    print(f"🌐 OLAP URL ({label}): {used_url}")
     resp.raise_for_status()
 
-    data = resp.json()
-    rows = []
-    for r in data.get("data", []):
-        oper_raw = r.get("DateTime.DateTyped")
-        oper_day = oper_raw[:10] if isinstance(oper_raw, str) else oper_raw
-
-        rows.append(
-            {
-                "department": r.get("Department"),
-                "oper_day": oper_day,
-                "product_num": r.get("Product.Num"),
-                "product_name": r.get("Product.Name"),
-                "product_type": r.get("Product.Type"),
-                "measure_unit": r.get("Product.MeasureUnit"),
-                "document": r.get("Document"),
-                "transaction_type": r.get("TransactionType"),
-                "turnover": float(r.get("Amount.StoreInOutTyped") or 0),
-            }
-        )
+    if LOW_MEMORY:
+        # raw-поток отдаём ijson, gzip распаковывает urllib3
+        resp.raw.decode_content = True
+        return ijson.items(resp.raw, "data.item", use_float=True)
 
-    print(f"✅ Получено строк из iiko: {len(rows)}")
-    print("🔎 Первые 10 строк из iiko:")
-    for i, x in enumerate(rows[:10], start=1):
-        print(f"{i:02d}. {x}")
+    # gzip запрашивается заголовком сессии, requests распаковывает сам; Content-Length — размер "на проводе"
+    print(
+        f"🗜️ OLAP ответ ({label}): encoding={resp.headers.get('Content-Encoding') or 'identity'}, "
+        f"на проводе={resp.headers.get('Content-Length') or '?'} байт, "
+        f"после распаковки={len(resp.content)} байт"
+    )
 
-    return rows
+    data = parse_json(resp)
+    return data.get("data", [])
+
+
+def fetch_stock_tx(token: str, date_from: dt.date, date_to: dt.date):
+    """
+    Генератор кортежей в порядке STAGE_COLS.
+    Подразделения качаются параллельно, строки отдаются по мере готовности каждого ответа.
+    """
+    print("📦 Загружаем OLAP 'Отчет по проводкам' из iiko...")
+
+    if LOW_MEMORY:
+        if ijson is None:
+            raise RuntimeError("LOW_MEMORY=1 требует пакет ijson (pip install ijson)")
+        # подразделения по очереди: следующий запрос уходит, когда предыдущий поток дочитан в COPY
+        raw_iter = chain.from_iterable(fetch_stock_tx_part(token, date_from, date_to, [d]) for d in DEPARTMENTS)
+        if PRODUCT_NUM_FILTER:
+            raw_iter = (r for r in raw_iter if r["Product.Num"] in PRODUCT_NUM_FILTER)
+        print("✅ LOW_MEMORY: строки из iiko читаются потоком прямо в COPY")
+        yield from map(project_stock_tx_row, raw_iter)
+        return
+
+    # OLAP по каждому подразделению считается отдельно и параллельно:
+    # время = самый медленный запрос, а не сумма. OLAP_CONCURRENCY=1 — один запрос на все подразделения.
+    if OLAP_CONCURRENCY > 1 and len(DEPARTMENTS) > 1:
+        with ThreadPoolExecutor(max_workers=min(OLAP_CONCURRENCY, len(DEPARTMENTS))) as ex:
+            futures = {ex.submit(fetch_stock_tx_part, token, date_from, date_to, [d]): d for d in DEPARTMENTS}
+            for fut in as_completed(futures):
+                yield from _project_part(futures[fut], fut.result())
+    else:
+        yield from _project_part(", ".join(DEPARTMENTS), fetch_stock_tx_part(token, date_from, date_to, DEPARTMENTS))
+
+
+def _project_part(label: str, raw_rows: list[dict]):
+    if PRODUCT_NUM_FILTER:
+        # защитно отбрасываем строки вне фильтра (если iiko вдруг проигнорировал Product.Num)
+        raw_rows = [r for r in raw_rows if r["Product.Num"] in PRODUCT_NUM_FILTER]
+
+    print(f"✅ Получено строк из iiko ({label}): {len(raw_rows)}")
+    if VERBOSE:
+        print(f"🔎 Первые 10 строк из iiko ({label}):")
+        for i, r in enumerate(raw_rows[:10], start=1):
+            print(f"{i:02d}. {project_stock_tx_row(r)}")
+
+    # кортежи строим лениво — прямо в COPY, без промежуточного list[dict]
+    return map(project_stock_tx_row, raw_rows)
+
+
+def start_stock_tx_pipeline(token: str, date_from: dt.date, date_to: dt.date, batch_size: int = 5000):
+    """
+    Producer/consumer: fetch_stock_tx крутится в отдельном потоке и кладёт пачки по batch_size строк
+    в ограниченную очередь, а возвращённый генератор отдаёт их в COPY по мере поступления.
+    Пока iiko отвечает / парсится ответ, Postgres уже создаёт staging и принимает первые пачки
+    (GIL отпускается и на сокетах requests, и внутри psycopg2).
+    """
+    q = queue.Queue(maxsize=4)
+
+    def produce():
+        try:
+            rows = fetch_stock_tx(token, date_from, date_to)
+            while batch := list(islice(rows, batch_size)):
+                q.put(batch)
+            q.put(None)
+        except BaseException as e:
+            q.put(e)
+
+    threading.Thread(target=produce, name="stock-tx-fetch", daemon=True).start()
+
+    def consume():
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield from item
+
+    return consume()
+
+
+# Все поля строки OLAP одним C-вызовом, в порядке STAGE_COLS
+_OLAP_ROW_GETTER = itemgetter(
+    "Department",
+    "DateTime.DateTyped",
+    "Product.Num",
+    "Product.Name",
+    "Product.Type",
+    "Product.MeasureUnit",
+    "Document",
+    "TransactionType",
+    AMOUNT_FIELD,
+)
+
+
+def project_stock_tx_row(r: dict, _get=_OLAP_ROW_GETTER) -> tuple:
+    """
+    Строка OLAP -> кортеж в порядке STAGE_COLS (document = "" приравниваем к NULL).
+    Все поля из groupByRowFields в ответе есть всегда, DateTyped — ISO-строка, поэтому без .get / isinstance.
+    """
+    department, oper_raw, product_num, product_name, product_type, measure_unit, document, transaction_type, amount = _get(r)
+    return (
+        department,
+        oper_raw[:10],
+        product_num,
+        product_name,
+        product_type,
+        measure_unit,
+        document or None,
+        transaction_type,
+        amount or 0,  # число из JSON (orjson/ijson уже отдают int/float) — без повторного float()
+    )
 
 
 # ========== DB schema helpers ==========
+# Кэш колонок: (id(conn), schema, table) -> set колонок (пустой set = таблицы нет).
+# Сбрасывается при открытии нового соединения в get_pg_connection.
+_COL_CACHE: dict[tuple[int, str, str], set[str]] = {}
+
+# Таблицы, которые нужны за один запуск — их колонки тянем одним запросом
+SCHEMA_TABLES = ["stock_tx_iiko", "batch_manual_anchor", "batch_anchor_diff", "batch_daily_lifecycle"]
+
+
+def prefetch_table_columns(conn, table_names: list[str], schema: str = "public"):
+    """Одним запросом к information_schema.columns заполняем _COL_CACHE для table_names."""
+    q = """
+        SELECT table_name, column_name
+        FROM information_schema.columns
+        WHERE table_schema = %s AND table_name = ANY(%s);
+    """
+    found = {t: set() for t in table_names}
+    with conn.cursor() as cur:
+        cur.execute(q, (schema, list(table_names)))
+        for table_name, column_name in cur.fetchall():
+            found[table_name].add(column_name)
+    for table_name, cols in found.items():
+        _COL_CACHE[(id(conn), schema, table_name)] = cols
+
+
 def get_table_columns(conn, table_name: str, schema: str = "public") -> set[str]:
+    key = (id(conn), schema, table_name)
+    if key in _COL_CACHE:
+        return _COL_CACHE[key]
+
     q = """
         SELECT column_name
         FROM information_schema.columns
@@ -233,19 +536,65 @@ def get_table_columns(conn, table_name: str, schema: str = "public") -> set[str]
     """
     with conn.cursor() as cur:
         cur.execute(q, (schema, table_name))
+        cols = {r[0] for r in cur.fetchall()}
+    _COL_CACHE[key] = cols
+    return cols
+
+
+def tables_exist(conn, names: list[str], schema: str = "public") -> set[str]:
+    """Одним запросом: какие из таблиц names есть в schema (если всё уже в кэше — без запроса)."""
+    keys = {name: (id(conn), schema, name) for name in names}
+    if all(k in _COL_CACHE for k in keys.values()):
+        return {name for name, k in keys.items() if _COL_CACHE[k]}
+
+    q = """
+        SELECT table_name
+        FROM information_schema.tables
+        WHERE table_schema = %s AND table_name = ANY(%s);
+    """
+    with conn.cursor() as cur:
+        cur.execute(q, (schema, list(names)))
         return {r[0] for r in cur.fetchall()}
 
 
-def table_exists(conn, table_name: str, schema: str = "public") -> bool:
+def ensure_index(conn, ddl: str) -> bool:
+    """
+    CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции —
+    поэтому на время DDL переключаем соединение в autocommit.
+    Ошибку не пробрасываем: без индекса всё работает, просто медленнее.
+    """
+    conn.commit()
+    prev_autocommit = conn.autocommit
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(ddl)
+        return True
+    except Exception as e:
+        print("⚠️ Не удалось создать индекс:", str(e)[:300])
+        return False
+    finally:
+        conn.autocommit = prev_autocommit
+
+
+# Схема stock_tx_iiko, разрешённая один раз за запуск и переданная всем, кому она нужна
+FrozenSchema = namedtuple("FrozenSchema", "cols has_document turnover_col")
+
+
+def resolve_schema(conn, table_name: str = "stock_tx_iiko", schema: str = "public") -> FrozenSchema:
+    cols = frozenset(get_table_columns(conn, table_name, schema))
+    return FrozenSchema(cols, "document" in cols, pick_turnover_column(cols))
+
+
+def canon_product_num_is_immutable(conn) -> bool:
     q = """
-        SELECT EXISTS (
-            SELECT 1
-            FROM information_schema.tables
-            WHERE table_schema = %s AND table_name = %s
-        );
+        SELECT COALESCE(bool_and(p.provolatile = 'i'), false)
+        FROM pg_proc p
+        JOIN pg_namespace n ON n.oid = p.pronamespace
+        WHERE n.nspname = 'public' AND p.proname = 'canon_product_num';
     """
     with conn.cursor() as cur:
-        cur.execute(q, (schema, table_name))
+        cur.execute(q)
         return bool(cur.fetchone()[0])
 
 
@@ -258,66 +607,114 @@ def pick_turnover_column(cols: set[str]) -> str:
     )
 
 
-def aggregate_rows(rows: list[dict], with_document: bool) -> list[dict]:
+# ========== Upsert ==========
+# Staging: TEMP-таблица (без WAL, живёт до commit) -> COPY -> ANALYZE -> INSERT ... SELECT ... ON CONFLICT
+STAGE_TABLE = "stg_stock_tx"
+# STOCK_TX_USE_COPY=0 — грузить staging через INSERT ... FROM unnest(массивы), если COPY недоступен
+STAGE_USE_COPY = os.getenv("STOCK_TX_USE_COPY", "1") != "0"
+STAGE_TEMP_BUFFERS = os.getenv("STOCK_TX_TEMP_BUFFERS", "64MB")
+# На Postgres 15+ строки С документом переносим MERGE вместо INSERT ... ON CONFLICT (STOCK_TX_USE_MERGE=0 — выключить).
+# Строки БЕЗ документа всегда идут через ON CONFLICT: MERGE матчит их по "document IS NULL", а уникальный индекс
+# (department, oper_day, product_num, document, transaction_type) видит такие строки дублями только при
+# NULLS NOT DISTINCT — семантику ключа для NULL оставляем индексу. MERGE не берёт блокировку на конфликт,
+# поэтому при пересекающихся запусках он может упасть на unique violation — тогда этот батч повторяем ON CONFLICT
+STAGE_USE_MERGE = os.getenv("STOCK_TX_USE_MERGE", "1") != "0"
+STAGE_COLS = [
+    "department",
+    "oper_day",
+    "product_num",
+    "product_name",
+    "product_type",
+    "measure_unit",
+    "document",
+    "transaction_type",
+    "turnover",
+]
+
+# COPY (FORMAT binary): без экранирования в Python и без текстового парсинга на сервере
+_COPY_BIN_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_COPY_BIN_TRAILER = struct.pack("!h", -1)
+_PG_EPOCH = dt.date(2000, 1, 1)
+
+
+class GenIO:
     """
-    Для with_document=True:
-      - уникальность: (department, product_num, document, transaction_type)
-      - oper_day = MAX
-      - turnover = SUM
-    Для without document — старая логика
+    Файлоподобная обёртка над генератором bytes: copy_expert читает из неё кусками через read(n),
+    поэтому весь COPY-поток целиком в памяти не собирается.
     """
 
-    agg = {}
-
-    for r in rows:
-        if with_document and r.get("document") not in (None, ""):
-            key = (
-                r.get("department"),
-                r.get("product_num"),
-                r.get("document"),
-                r.get("transaction_type"),
-            )
-        else:
-            key = (
-                r.get("department"),
-                r.get("oper_day"),
-                r.get("product_num"),
-                r.get("transaction_type"),
-            )
-
-        if key not in agg:
-            agg[key] = dict(r)
+    def __init__(self, gen):
+        self.gen = gen
+        self.buf = b""
+
+    def read(self, n: int = -1) -> bytes:
+        while n < 0 or len(self.buf) < n:
+            try:
+                self.buf += next(self.gen)
+            except StopIteration:
+                break
+        if n < 0:
+            out, self.buf = self.buf, b""
         else:
-            # суммируем оборот
-            agg[key]["turnover"] = float(agg[key].get("turnover") or 0) + float(r.get("turnover") or 0)
+            out, self.buf = self.buf[:n], self.buf[n:]
+        return out
 
-            # для document — обновляем oper_day на максимальный
-            if with_document and r.get("document") not in (None, ""):
-                agg[key]["oper_day"] = max(agg[key]["oper_day"], r.get("oper_day"))
 
-    out = list(agg.values())
-    print(f"📌 После агрегации ({'с document' if with_document else 'без document'}): {len(out)} строк")
-    return out
+def iter_stage_binary(rows, encoding: str = "utf-8"):
+    """
+    Кортежи в порядке STAGE_COLS -> поток COPY (FORMAT binary).
+    Типы полей как в staging: text x6, date, text, float8 (порядок — STAGE_COLS).
+    """
+    pack_len = struct.Struct("!i").pack
+    pack_date = struct.Struct("!ii").pack
+    pack_float8 = struct.Struct("!id").pack
+    n_fields = struct.pack("!h", len(STAGE_COLS))
+    null = pack_len(-1)
+
+    def text(v):
+        if v is None:
+            return null
+        b = str(v).encode(encoding)
+        return pack_len(len(b)) + b
+
+    yield _COPY_BIN_HEADER
+    for department, oper_day, product_num, product_name, product_type, measure_unit, document, transaction_type, turnover in rows:
+        if oper_day is None:
+            day = null
+        else:
+            if isinstance(oper_day, str):
+                oper_day = dt.date.fromisoformat(oper_day)
+            day = pack_date(4, (oper_day - _PG_EPOCH).days)
+
+        yield b"".join(
+            (
+                n_fields,
+                text(department),
+                day,
+                text(product_num),
+                text(product_name),
+                text(product_type),
+                text(measure_unit),
+                text(document),
+                text(transaction_type),
+                pack_float8(8, turnover),
+            )
+        )
+    yield _COPY_BIN_TRAILER
 
-# ========== Upsert ==========
-def upsert_stock_tx(conn, rows: list[dict]):
-    if not rows:
-        print("⚠️ Нет строк для записи в БД")
-        return 0
 
-    cols = get_table_columns(conn, "stock_tx_iiko", "public")
-    has_document = "document" in cols
-    turnover_col = pick_turnover_column(cols)
+def upsert_stock_tx(conn, rows: Iterable[tuple], tx_schema: FrozenSchema | None = None):
+    """
+    rows — кортежи в порядке STAGE_COLS (можно генератор: читается один раз, прямо в COPY).
+    tx_schema — схема stock_tx_iiko, если уже известна (иначе спросим у БД).
+    """
+    if tx_schema is None:
+        tx_schema = resolve_schema(conn)
+    turnover_col = tx_schema.turnover_col
 
-    if not has_document:
+    if not tx_schema.has_document:
         raise RuntimeError("В stock_tx_iiko нет колонки document — текущая стратегия уникальности невозможна")
 
-    rows = aggregate_rows(rows, with_document=True)
-
-    # Разделяем потоки: с документом и без документа
-    rows_with_doc = [r for r in rows if r.get("document") not in (None, "")]
-    rows_no_doc = [r for r in rows if r.get("document") in (None, "")]
-
     insert_cols = [
         "department",
         "oper_day",
@@ -331,113 +728,246 @@ def upsert_stock_tx(conn, rows: list[dict]):
         "updated_at",
     ]
     cols_sql = ", ".join(insert_cols)
+    stage_cols_sql = ", ".join(STAGE_COLS)
 
-    placeholders = ["%s"] * (len(insert_cols) - 1)
-    template = "(" + ",".join(placeholders) + ",now())"
-
-    total_written = 0
+    # Агрегация — в Postgres (GROUP BY по staging), а не в Python:
+    # - с документом: уникальность (department, product_num, document, transaction_type),
+    #   oper_day = MAX, turnover = SUM
+    # - без документа: уникальность (department, oper_day, product_num, transaction_type), turnover = SUM
 
     # ---------- 1) UPSERT для строк С документом ----------
     # ВАЖНО:
     # - конфликт таргет: (department, product_num, document, transaction_type) WHERE document IS NOT NULL
     # - при апдейте обновляем oper_day (документ мог "переехать" на другую дату)
-    if rows_with_doc:
-        values = []
-        for r in rows_with_doc:
-            values.append(
-                (
-                    r.get("department"),
-                    r.get("oper_day"),
-                    r.get("product_num"),
-                    r.get("product_name"),
-                    r.get("product_type"),
-                    r.get("measure_unit"),
-                    r.get("document"),
-                    r.get("transaction_type"),
-                    float(r.get("turnover") or 0),
-                )
-            )
-
-        sql_with_doc = f"""
-            INSERT INTO stock_tx_iiko ({cols_sql})
-            VALUES %s
-            ON CONFLICT (department, product_num, document, transaction_type)
-            WHERE document IS NOT NULL
-            DO UPDATE SET
-                oper_day = EXCLUDED.oper_day,
-                product_name = EXCLUDED.product_name,
-                product_type = EXCLUDED.product_type,
-                measure_unit = EXCLUDED.measure_unit,
-                {turnover_col} = EXCLUDED.{turnover_col},
-                updated_at = now();
-        """
-
-        with conn.cursor() as cur:
-            execute_values(cur, sql_with_doc, values, template=template, page_size=500)
-
-        conn.commit()
-        total_written += len(values)
-        print(f"✅ upsert (by doc key) записано: {len(values)}")
+    sql_with_doc = f"""
+        INSERT INTO stock_tx_iiko ({cols_sql})
+        SELECT
+            department,
+            MAX(oper_day),
+            product_num,
+            MAX(product_name),
+            MAX(product_type),
+            MAX(measure_unit),
+            document,
+            transaction_type,
+            SUM(turnover),
+            now()
+        FROM {STAGE_TABLE}
+        WHERE document IS NOT NULL
+        GROUP BY department, product_num, document, transaction_type
+        ON CONFLICT (department, product_num, document, transaction_type)
+        WHERE document IS NOT NULL
+        DO UPDATE SET
+            oper_day = EXCLUDED.oper_day,
+            product_name = EXCLUDED.product_name,
+            product_type = EXCLUDED.product_type,
+            measure_unit = EXCLUDED.measure_unit,
+            {turnover_col} = EXCLUDED.{turnover_col},
+            updated_at = now();
+    """
 
     # ---------- 2) UPSERT для строк БЕЗ документа ----------
     # Тут оставляем “старую” привязку к oper_day, потому что документ = NULL (уникализировать нечем)
-    if rows_no_doc:
-        values = []
-        for r in rows_no_doc:
-            # document кладём как None
-            values.append(
-                (
-                    r.get("department"),
-                    r.get("oper_day"),
-                    r.get("product_num"),
-                    r.get("product_name"),
-                    r.get("product_type"),
-                    r.get("measure_unit"),
-                    None,
-                    r.get("transaction_type"),
-                    float(r.get("turnover") or 0),
-                )
-            )
+    sql_no_doc = f"""
+        INSERT INTO stock_tx_iiko ({cols_sql})
+        SELECT
+            department,
+            oper_day,
+            product_num,
+            MAX(product_name),
+            MAX(product_type),
+            MAX(measure_unit),
+            NULL::text,
+            transaction_type,
+            SUM(turnover),
+            now()
+        FROM {STAGE_TABLE}
+        WHERE document IS NULL
+        GROUP BY department, oper_day, product_num, transaction_type
+        ON CONFLICT (department, oper_day, product_num, document, transaction_type)
+        DO UPDATE SET
+            product_name = EXCLUDED.product_name,
+            product_type = EXCLUDED.product_type,
+            measure_unit = EXCLUDED.measure_unit,
+            {turnover_col} = EXCLUDED.{turnover_col},
+            updated_at = now();
+    """
 
-        sql_no_doc = f"""
-            INSERT INTO stock_tx_iiko ({cols_sql})
-            VALUES %s
-            ON CONFLICT (department, oper_day, product_num, document, transaction_type)
-            DO UPDATE SET
-                product_name = EXCLUDED.product_name,
-                product_type = EXCLUDED.product_type,
-                measure_unit = EXCLUDED.measure_unit,
-                {turnover_col} = EXCLUDED.{turnover_col},
-                updated_at = now();
+    # Postgres 15+: строки с документом через MERGE — без спекулятивной вставки и повторной пробы индекса
+    # на конфликте. Совпадение ищем по тем же ключам, что и частичный уникальный индекс под ON CONFLICT.
+    sql_with_doc_merge = None
+    if STAGE_USE_MERGE and conn.server_version >= 150000:
+        sql_with_doc_merge = f"""
+            MERGE INTO stock_tx_iiko t
+            USING (
+                SELECT
+                    department,
+                    MAX(oper_day) AS oper_day,
+                    product_num,
+                    MAX(product_name) AS product_name,
+                    MAX(product_type) AS product_type,
+                    MAX(measure_unit) AS measure_unit,
+                    document,
+                    transaction_type,
+                    SUM(turnover) AS turnover
+                FROM {STAGE_TABLE}
+                WHERE document IS NOT NULL
+                GROUP BY department, product_num, document, transaction_type
+            ) s
+            ON t.department = s.department
+               AND t.product_num = s.product_num
+               AND t.document = s.document
+               AND t.transaction_type = s.transaction_type
+            WHEN MATCHED THEN UPDATE SET
+                oper_day = s.oper_day,
+                product_name = s.product_name,
+                product_type = s.product_type,
+                measure_unit = s.measure_unit,
+                {turnover_col} = s.turnover,
+                updated_at = now()
+            WHEN NOT MATCHED THEN
+                INSERT ({cols_sql})
+                VALUES (
+                    s.department, s.oper_day, s.product_num, s.product_name, s.product_type,
+                    s.measure_unit, s.document, s.transaction_type, s.turnover, now()
+                );
         """
 
+    try:
         with conn.cursor() as cur:
-            execute_values(cur, sql_no_doc, values, template=template, page_size=500)
+            # temp_buffers: staging целиком в памяти бэкенда (по умолчанию 8MB, дальше — на диск).
+            # Best-effort: Postgres не даёт менять значение, если бэкенд уже трогал TEMP-таблицы
+            # (переиспользованное соединение за pooler'ом Neon) — тогда откатываем savepoint и едем дальше
+            try:
+                cur.execute(
+                    "SAVEPOINT stage_temp_buffers; SET LOCAL temp_buffers = %s; RELEASE SAVEPOINT stage_temp_buffers;",
+                    (STAGE_TEMP_BUFFERS,),
+                )
+            except psycopg2.Error as e:
+                cur.execute("ROLLBACK TO SAVEPOINT stage_temp_buffers;")
+                print("⚠️ temp_buffers не применён, staging как есть:", str(e).strip()[:200])
+
+            # Остальные настройки транзакции и staging — одним execute (один round trip вместо двух):
+            # - synchronous_commit = off: commit не ждёт fsync WAL, загрузка идемпотентна (ON CONFLICT / MERGE),
+            #   при сбое просто перезапускаем
+            # - TEMP-таблица и так не пишет WAL; ON COMMIT DROP — убирается сама
+            cur.execute(
+                f"""
+                SET LOCAL synchronous_commit = off;
+                CREATE TEMP TABLE {STAGE_TABLE} (
+                    department       text,
+                    oper_day         date,
+                    product_num      text,
+                    product_name     text,
+                    product_type     text,
+                    measure_unit     text,
+                    document         text,
+                    transaction_type text,
+                    turnover         double precision
+                ) ON COMMIT DROP;
+                """
+            )
+            copied = 0
+
+            def counted(it):
+                nonlocal copied
+                for t in it:
+                    copied += 1
+                    yield t
+
+            if STAGE_USE_COPY:
+                cur.copy_expert(
+                    f"COPY {STAGE_TABLE} ({stage_cols_sql}) FROM STDIN WITH (FORMAT binary)",
+                    GenIO(iter_stage_binary(counted(rows), encodings[conn.encoding])),
+                )
+            else:
+                # fallback без COPY (например, прокси/пулер его не пропускает):
+                # колонки массивами и один INSERT ... SELECT FROM unnest(...) — один round trip на весь набор
+                columns = list(zip(*counted(rows))) or [()] * len(STAGE_COLS)
+                cur.execute(
+                    f"""
+                    INSERT INTO {STAGE_TABLE} ({stage_cols_sql})
+                    SELECT * FROM unnest(
+                        %s::text[], %s::date[], %s::text[], %s::text[], %s::text[],
+                        %s::text[], %s::text[], %s::text[], %s::float8[]
+                    );
+                    """,
+                    [list(c) for c in columns],
+                )
+            if copied == 0:
+                conn.rollback()
+                print("⚠️ Нет строк для записи в БД")
+                return 0
+
+            # статистика для планировщика (иначе на TEMP-таблице он гадает по размерам) — в одном
+            # round trip с первым upsert; rowcount у psycopg2 берётся от последней команды, т.е. от upsert
+            if sql_with_doc_merge is None:
+                cur.execute(f"ANALYZE {STAGE_TABLE};\n{sql_with_doc}")
+                n_with_doc = cur.rowcount
+            else:
+                # параллельный запуск успел вставить тот же ключ между MERGE-проверкой и вставкой:
+                # откатываем только MERGE и повторяем батч через ON CONFLICT (он на конфликте ждёт и обновляет)
+                try:
+                    cur.execute(f"ANALYZE {STAGE_TABLE};\nSAVEPOINT stage_merge;\n{sql_with_doc_merge}")
+                    n_with_doc = cur.rowcount
+                    cur.execute("RELEASE SAVEPOINT stage_merge;")
+                except psycopg2.IntegrityError:
+                    cur.execute("ROLLBACK TO SAVEPOINT stage_merge;")
+                    print("⚠️ MERGE упал на unique violation (пересекающийся запуск?) — повторяю через ON CONFLICT")
+                    cur.execute(sql_with_doc)
+                    n_with_doc = cur.rowcount
+            print(f"✅ upsert (by doc key) записано: {n_with_doc}")
+
+            cur.execute(sql_no_doc)
+            n_no_doc = cur.rowcount
+            print(f"✅ upsert (by day key, doc=NULL) записано: {n_no_doc}")
 
         conn.commit()
-        total_written += len(values)
-        print(f"✅ upsert (by day key, doc=NULL) записано: {len(values)}")
+    except Exception:
+        conn.rollback()
+        raise
 
-    return total_written
+    return n_with_doc + n_no_doc
 
 
-def print_db_sample(conn, date_from: dt.date, date_to: dt.date):
-    cols = get_table_columns(conn, "stock_tx_iiko", "public")
-    has_document = "document" in cols
-    turnover_col = pick_turnover_column(cols)
+def ensure_stock_tx_indexes(conn, tx_schema: FrozenSchema):
+    """
+    Покрывающий индекс под print_db_sample (диапазон oper_day + сортировка) — index-only scan.
+    Строится только по STOCK_TX_SAMPLE_INDEX=1 (разовая операция, не на каждый запуск).
+    Уникальные индексы под оба ON CONFLICT обязаны уже быть: без них upsert падает с ошибкой.
+    """
+    include_cols = ["document"] if tx_schema.has_document else []
+    include_cols += ["transaction_type", tx_schema.turnover_col]
+    ensure_index(
+        conn,
+        f"""
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_stock_tx_iiko_operday_dep_prod
+        ON public.stock_tx_iiko (oper_day, department, product_num)
+        INCLUDE ({", ".join(include_cols)});
+        """,
+    )
+
+
+def print_db_sample(conn, date_from: dt.date, date_to: dt.date, tx_schema: FrozenSchema | None = None):
+    # отладочный вывод — только по ETL_PRINT_SAMPLE=1, в обычном запуске лишний запрос не делаем
+    if not PRINT_DB_SAMPLE:
+        return
+
+    if tx_schema is None:
+        tx_schema = resolve_schema(conn)
 
     print("🗄️ Первые 10 строк из БД за период:")
 
     select_cols = ["department", "oper_day", "product_num"]
-    if has_document:
+    if tx_schema.has_document:
         select_cols.append("document")
-    select_cols += ["transaction_type", turnover_col]
+    select_cols += ["transaction_type", tx_schema.turnover_col]
 
     q = f"""
         SELECT {", ".join(select_cols)}
         FROM stock_tx_iiko
         WHERE oper_day >= %s AND oper_day < %s
-        ORDER BY oper_day, department, product_num
+        ORDER BY oper_day, department, product_num  -- порядок индекса ix_stock_tx_iiko_operday_dep_prod (если построен): без сортировки
         LIMIT 10;
     """
     with conn.cursor() as cur:
@@ -483,6 +1013,15 @@ def refresh_datalens_tail(conn, date_from: dt.date, date_to: dt.date):
 
 
 # ========== Refresh anchor diffs (Plan/Fact discrepancies) ==========
+# Функциональный индекс под LEFT JOIN prep_items_ref по canon_product_num(...)
+ANCHOR_DIFF_INDEXES = [
+    """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS prep_items_ref_canon_num_idx
+    ON public.prep_items_ref (public.canon_product_num(product_num));
+    """,
+]
+
+
 def refresh_anchor_discrepancies(conn):
     """
     Итоговое поведение:
@@ -490,49 +1029,118 @@ def refresh_anchor_discrepancies(conn):
     - список товаров берём из инвенты (batch_manual_anchor),
       а партии (production_day) показываем ВСЕ из batch_daily_lifecycle по этим товарам на anchor_day
     - если якорей нет -> batch_anchor_diff будет пустой
+
+    Пересчёт инкрементальный: трогаем только ключи (department, product_num, anchor_day),
+    у которых поменялись строки инвенты или строки плана batch_daily_lifecycle на anchor_day
+    (оба хэша в batch_anchor_diff_state), или которые удалили. План ловится по хэшу, а не по окну
+    дат: lifecycle пересчитывают и вне хвоста этого запуска (fallback по p_days, ручная пересборка).
+    ANCHOR_DIFF_FULL_REFRESH=1 — пересобрать все ключи.
     """
 
-    # таблицы-источники
-    if not table_exists(conn, "batch_manual_anchor", "public"):
+    # таблицы-источники (одним запросом к information_schema)
+    present = tables_exist(conn, ["batch_manual_anchor", "batch_anchor_diff", "batch_daily_lifecycle"], "public")
+    if "batch_manual_anchor" not in present:
         print("ℹ️ batch_manual_anchor не существует — пропускаю пересчёт расхождений")
         return
-    if not table_exists(conn, "batch_anchor_diff", "public"):
+    if "batch_anchor_diff" not in present:
         print("ℹ️ batch_anchor_diff не существует — пропускаю пересчёт расхождений")
         return
-    if not table_exists(conn, "batch_daily_lifecycle", "public"):
+    if "batch_daily_lifecycle" not in present:
         print("ℹ️ batch_daily_lifecycle не существует — пропускаю пересчёт расхождений")
         return
 
-    print("🧩 Пересчёт таблицы расхождений (detail) по якорям...")
+    # функциональный индекс возможен (и нужен планировщику) только для IMMUTABLE-функции
+    if canon_product_num_is_immutable(conn):
+        for ddl in ANCHOR_DIFF_INDEXES:
+            ensure_index(conn, ddl)
+    else:
+        print(
+            "⚠️ public.canon_product_num не IMMUTABLE (или её нет) — индекс по canon_product_num не создаю. "
+            "Если функция чистая: ALTER FUNCTION public.canon_product_num(text) IMMUTABLE PARALLEL SAFE;"
+        )
 
-    with conn.cursor() as cur:
-        # 0) очищаем detail
-        try:
-            cur.execute("TRUNCATE TABLE public.batch_anchor_diff;")
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise RuntimeError(f"Не смог TRUNCATE public.batch_anchor_diff: {e}")
+    full_refresh = os.getenv("ANCHOR_DIFF_FULL_REFRESH") == "1"
+    print(f"🧩 Пересчёт таблицы расхождений (detail) по якорям{' (полный)' if full_refresh else ''}...")
+
+    # 0) ключи, которые надо пересчитать:
+    #    - хэш строк инвенты по ключу отличается от сохранённого (новые / изменённые)
+    #    - ключ был в state, но пропал из инвенты (удалённые якоря -> удаляем расхождения)
+    #    - хэш строк batch_daily_lifecycle на anchor_day по ключу отличается (поменялся план)
+    state_sql = """
+        CREATE TABLE IF NOT EXISTS public.batch_anchor_diff_state (
+          department  text NOT NULL,
+          product_num text NOT NULL,
+          anchor_day  date NOT NULL,
+          anchor_hash text NOT NULL,
+          plan_hash   text,
+          PRIMARY KEY (department, product_num, anchor_day)
+        );
+        -- state, созданный до plan_hash: NULL != текущий хэш -> ключи один раз пересчитаются
+        ALTER TABLE public.batch_anchor_diff_state ADD COLUMN IF NOT EXISTS plan_hash text;
+    """
+    if full_refresh:
+        # полный пересчёт: обе таблицы чистим одним TRUNCATE (дешевле DELETE по всем ключам),
+        # тогда changed_scope = все текущие якоря
+        state_sql += """
+        TRUNCATE TABLE public.batch_anchor_diff, public.batch_anchor_diff_state RESTART IDENTITY;
+    """
 
-        # 1) если якорей нет — оставляем пустой
-        cur.execute("SELECT COUNT(*) FROM public.batch_manual_anchor;")
-        anchors_cnt = int(cur.fetchone()[0])
-        if anchors_cnt == 0:
-            conn.commit()
-            print("✅ Якорей нет — batch_anchor_diff оставлена пустой")
-            return
+    scope_sql = """
+        CREATE TEMP TABLE changed_scope ON COMMIT DROP AS
+        WITH cur AS (
+          SELECT
+            a.department::text  AS department,
+            a.product_num::text AS product_num,
+            a.anchor_day::date  AS anchor_day,
+            md5(string_agg(a::text, '|' ORDER BY a::text)) AS anchor_hash
+          FROM public.batch_manual_anchor a
+          GROUP BY 1, 2, 3
+        ),
+        -- только колонки, которые идут в detail (updated_at и т.п. не должны давать "изменений");
+        -- нет строк плана -> NULL, и NULL = NULL для IS DISTINCT FROM
+        plan AS (
+          SELECT
+            c.department,
+            c.product_num,
+            c.anchor_day,
+            md5(string_agg(
+              concat_ws(';', l.production_day, l.qty_closing, l.product_name), '|'
+              ORDER BY l.production_day, l.qty_closing, l.product_name
+            )) AS plan_hash
+          FROM cur c
+          JOIN public.batch_daily_lifecycle l
+            ON l.department = c.department
+           AND l.snapshot_day = c.anchor_day
+           AND l.product_num = c.product_num
+          GROUP BY 1, 2, 3
+        )
+        SELECT department, product_num, anchor_day, c.anchor_hash, p.plan_hash
+        FROM cur c
+        LEFT JOIN plan p USING (department, product_num, anchor_day)
+        FULL OUTER JOIN public.batch_anchor_diff_state s USING (department, product_num, anchor_day)
+        WHERE %(full)s
+           OR c.anchor_hash IS DISTINCT FROM s.anchor_hash
+           OR p.plan_hash IS DISTINCT FROM s.plan_hash;
+    """
+
+    # 1) собираем detail по финальной логике, но только по changed_scope:
+    #    товары из инвенты + все партии по ним на anchor_day
+    sql = """
+        DELETE FROM public.batch_anchor_diff d
+        USING changed_scope c
+        WHERE d.department = c.department
+          AND d.product_num = c.product_num
+          AND d.anchor_day = c.anchor_day;
 
-        # 2) собираем detail по финальной логике:
-        #    товары из инвенты + все партии по ним на anchor_day
-        sql = """
         WITH inv_scope AS (
-          SELECT DISTINCT
+          SELECT
             department,
             anchor_day,
             product_num
-          FROM public.batch_manual_anchor
+          FROM changed_scope
+          WHERE anchor_hash IS NOT NULL
         ),
-        plan_scope AS (
+        plan_scope AS MATERIALIZED (
           SELECT
             l.department,
             l.product_num,
@@ -555,6 +1163,10 @@ def refresh_anchor_discrepancies(conn):
             a.production_day,
             a.qty_fact AS fact_qty
           FROM public.batch_manual_anchor a
+          JOIN inv_scope s
+            ON s.department = a.department
+           AND s.anchor_day = a.anchor_day
+           AND s.product_num = a.product_num
         ),
         x AS (
           SELECT
@@ -601,37 +1213,89 @@ def refresh_anchor_discrepancies(conn):
           now()
         FROM x
         WHERE plan_qty <> 0 OR fact_qty <> 0;
+
+        DELETE FROM public.batch_anchor_diff_state s
+        USING changed_scope c
+        WHERE s.department = c.department
+          AND s.product_num = c.product_num
+          AND s.anchor_day = c.anchor_day;
+
+        INSERT INTO public.batch_anchor_diff_state (department, product_num, anchor_day, anchor_hash, plan_hash)
+        SELECT department, product_num, anchor_day, anchor_hash, plan_hash
+        FROM changed_scope
+        WHERE anchor_hash IS NOT NULL;
+
+        SELECT COUNT(*) FROM changed_scope;
         """
 
+    # scope + пересчёт + state — одним батчем: один round trip и один commit.
+    # Если ничего не поменялось, DELETE/INSERT по пустому changed_scope ничего не делают.
+    with conn.cursor() as cur:
         try:
-            cur.execute(sql)
+            cur.execute(state_sql + scope_sql + sql, {"full": full_refresh})
+            changed_cnt = int(cur.fetchone()[0])
             conn.commit()
-            print("✅ batch_anchor_diff пересобрана (товары из инвенты + все партии по ним)")
         except Exception as e:
             conn.rollback()
             raise RuntimeError(f"Ошибка пересчёта batch_anchor_diff: {e}")
 
+    if changed_cnt == 0:
+        print("✅ Якоря и план по ним не менялись — batch_anchor_diff без изменений")
+    else:
+        print(f"✅ batch_anchor_diff обновлена по {changed_cnt} ключам (товары из инвенты + все партии по ним)")
+
+
+def open_pg_and_introspect():
+    """Соединение с Postgres + FrozenSchema stock_tx_iiko (колонки прочих таблиц запуска — в кэш)."""
+    conn = get_pg_connection()
+    try:
+        prefetch_table_columns(conn, SCHEMA_TABLES, "public")
+        return conn, resolve_schema(conn)
+    except Exception:
+        conn.close()
+        raise
+
 
 def main():
     date_from, date_to = get_period()
     print(f"🚀 ETL STOCK TX: {date_from} – {date_to}")
     print(f"🌐 IIKO_BASE_URL: {IIKO_BASE_URL}")
 
-    token = get_token()
+    # auth в iiko и подключение к Postgres независимы — делаем параллельно
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        fut_token = ex.submit(get_token)
+        fut_pg = ex.submit(open_pg_and_introspect)
+
     try:
-        rows = fetch_stock_tx(token, date_from, date_to)
+        token = fut_token.result()
+    except Exception:
+        if fut_pg.exception() is None:
+            fut_pg.result()[0].close()
+        raise
 
-        conn = get_pg_connection()
+    try:
         try:
-            n = upsert_stock_tx(conn, rows)
+            conn, tx_schema = fut_pg.result()
+        except Exception:
+            print("⚠️ Не удалось подключиться к Postgres")
+            raise
+
+        try:
+            # загрузка из iiko идёт в фоне, upsert читает строки по мере поступления
+            rows = start_stock_tx_pipeline(token, date_from, date_to)
+
+            n = upsert_stock_tx(conn, rows, tx_schema)
             print(f"✅ В stock_tx_iiko upsert'нуто строк: {n}")
-            print_db_sample(conn, date_from, date_to)
+            # индекс строится по своему флагу, независимо от ETL_PRINT_SAMPLE
+            if ENSURE_SAMPLE_INDEX:
+                ensure_stock_tx_indexes(conn, tx_schema)
+            print_db_sample(conn, date_from, date_to, tx_schema)
 
             # ✅ 1) Обновляем витрину для DataLens
             refresh_datalens_tail(conn, date_from, date_to)
 
             # ✅ 2) СРАЗУ ПОСЛЕ витрины пересобираем таблицы расхождений по якорям
-            #    (полная пересборка каждый запуск -> удалил якоря -> расхождения исчезли)
+            #    (удалил якоря -> расхождения по ним исчезли; пересчитываются только изменённые ключи)
             refresh_anchor_discrepancies(conn)
 
         finally:
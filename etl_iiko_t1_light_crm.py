@@ -1,10 +1,35 @@
 import os
+import random
+import sys
+import json
+import io
+import csv
 import datetime as dt
 import time
+from collections.abc import Iterable
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from operator import itemgetter
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import psycopg2
+from psycopg2.extensions import make_dsn
+from psycopg2.pool import ThreadedConnectionPool
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:  # без колеса orjson работаем на stdlib json (через resp.json())
+    orjson = None
+
+try:
+    import ijson
+except ImportError:  # нужен только для LOW_MEMORY=1
+    ijson = None
+
 load_dotenv()
 
 IIKO_BASE_URL = os.getenv("IIKO_BASE_URL", "").rstrip("/")
@@ -19,28 +44,239 @@ HTTP_READ_TIMEOUT = int(os.getenv("HTTP_READ_TIMEOUT", "300"))
 HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
 HTTP_RETRY_SLEEP_SEC = int(os.getenv("HTTP_RETRY_SLEEP_SEC", "5"))
 
-# Размер чанка в днях (по умолчанию 7 = неделя)
+# Размер первого чанка в днях (по умолчанию 7 = неделя)
 CHUNK_DAYS = int(os.getenv("CHUNK_DAYS", "7"))
 
+# Следующие чанки подбираются по плотности предыдущего: ~ROWS_PER_CHUNK_TARGET строк на запрос,
+# но не длиннее MAX_CHUNK_DAYS. ROWS_PER_CHUNK_TARGET=0 — фиксированные чанки по CHUNK_DAYS
+ROWS_PER_CHUNK_TARGET = int(os.getenv("ROWS_PER_CHUNK_TARGET", "20000"))
+MAX_CHUNK_DAYS = int(os.getenv("MAX_CHUNK_DAYS", "14"))
+
+# LOW_MEMORY=1 — потоковый разбор OLAP через ijson: строки идут в COPY по мере чтения ответа,
+# весь JSON чанка в памяти не держим (медленнее orjson по CPU)
+LOW_MEMORY = os.getenv("LOW_MEMORY") == "1"
+
+# IIKO_TOKEN_CACHE=1 — переиспользовать токен iiko между запусками (файл рядом со скриптом), без logout в конце.
+# Включать только там, где файл переживает запуск (свой сервер / actions/cache): на свежем раннере
+# кэш не прочитается, а незакрытая сессия держит лицензию iiko до истечения.
+# По умолчанию — каждый раз auth + logout. IIKO_TOKEN_TTL_SEC — сколько считаем токен живым
+IIKO_TOKEN_CACHE = os.getenv("IIKO_TOKEN_CACHE") == "1"
+IIKO_TOKEN_TTL_SEC = int(os.getenv("IIKO_TOKEN_TTL_SEC", "900"))
+IIKO_TOKEN_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".iiko_token_cache")
+
+# Сколько чанков (fetch + upsert) обрабатываем одновременно
+T1_WORKERS = int(os.getenv("T1_WORKERS", "4"))
+
+# Куда грузим: по умолчанию CRM-проект Neon (PG_CRM_*, crm.iiko_t1_light).
+# Основная база — тем же скриптом: PG_ENV_PREFIX=PG_ T1_TARGET_TABLE=iiko_t1_light
+PG_ENV_PREFIX = os.getenv("PG_ENV_PREFIX", "PG_CRM_")
+T1_TARGET_TABLE = os.getenv("T1_TARGET_TABLE", "crm.iiko_t1_light")
+
+# Поля OLAP в порядке колонок T1_TARGET_TABLE (они же groupByRowFields)
+T1_LIGHT_FIELDS = (
+    "Delivery.CookingFinishTime",
+    "OpenTime",
+    "Delivery.PrintTime",
+    "Delivery.SendTime",
+    "Delivery.ActualTime",
+    "Delivery.CloseTime",
+    "Delivery.ExpectedTime",
+    "OpenDate.Typed",
+    "Delivery.SourceKey",
+    "Delivery.DeliveryComment",
+    "Department",
+    "Delivery.Region",
+    "Delivery.Number",
+    "Delivery.CustomerName",
+    "Delivery.Phone",
+    "Delivery.Address",
+    "Delivery.Courier",
+)
+
+# Колонки T1_TARGET_TABLE в том же порядке, что и T1_LIGHT_FIELDS
+T1_LIGHT_COLS = (
+    "delivery_cooking_finish_time",
+    "open_time",
+    "delivery_print_time",
+    "delivery_send_time",
+    "delivery_actual_time",
+    "delivery_close_time",
+    "delivery_expected_time",
+    "open_date",
+    "delivery_source_key",
+    "delivery_comment",
+    "department",
+    "delivery_region",
+    "delivery_number",
+    "delivery_customer_name",
+    "delivery_phone",
+    "delivery_address",
+    "delivery_courier",
+)
+
+T1_STAGE_TABLE = "stg_t1_light"
+
+# Ключ уникальности T1_TARGET_TABLE (ON CONFLICT)
+T1_LIGHT_KEY_COLS = ("department", "delivery_cooking_finish_time", "delivery_number")
+
+
+def _accept_encoding() -> str:
+    # br просим только если urllib3 сможет его распаковать (нужен пакет brotli / brotlicffi)
+    try:
+        import brotli  # noqa: F401
+    except ImportError:
+        try:
+            import brotlicffi  # noqa: F401
+        except ImportError:
+            return "gzip, deflate"
+    return "gzip, deflate, br"
+
+
+class _JitterRetry(Retry):
+    """
+    Экспоненциальная пауза urllib3 (не больше 60с) с разбросом x0.5–1.5: параллельные чанки,
+    упавшие на одном сбое iiko, не повторяют запросы синхронно.
+    """
+
+    def get_backoff_time(self) -> float:
+        return min(60.0, super().get_backoff_time()) * random.uniform(0.5, 1.5)
+
+
+# Одна keep-alive сессия на все потоки: auth / OLAP / logout идут по уже открытым TCP+TLS соединениям.
+# Сетевые ошибки и 502/503/504 повторяет urllib3 с экспоненциальной паузой (HTTP_RETRY_SLEEP_SEC * 2^n, с разбросом);
+# POST тоже: OLAP-отчёт и logout идемпотентны
+_SESSION = requests.Session()
+_HTTP_ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=_JitterRetry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_RETRY_SLEEP_SEC,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(["GET", "POST"]),
+        raise_on_status=False,  # последний 5xx отдаём как ответ — ниже печатаем тело и raise_for_status
+    ),
+)
+_SESSION.mount("https://", _HTTP_ADAPTER)
+_SESSION.mount("http://", _HTTP_ADAPTER)
+# сжатый ответ OLAP (JSON жмётся в разы); тело запроса — ~1KB, его не сжимаем
+_SESSION.headers.update({"Connection": "keep-alive", "Accept-Encoding": _accept_encoding()})
+
+# Перевыпуск токена на 401 — под замком, чтобы параллельные чанки не плодили токены
+_TOKEN_LOCK = threading.Lock()
+
+
+# Параметры подключения собираем в DSN один раз при импорте (незаданные — None — make_dsn отбрасывает)
+PG_DSN = make_dsn(
+    host=os.getenv(f"{PG_ENV_PREFIX}HOST"),
+    port=os.getenv(f"{PG_ENV_PREFIX}PORT"),
+    dbname=os.getenv(f"{PG_ENV_PREFIX}DB"),
+    user=os.getenv(f"{PG_ENV_PREFIX}USER"),
+    password=os.getenv(f"{PG_ENV_PREFIX}PASSWORD"),
+    sslmode=os.getenv(f"{PG_ENV_PREFIX}SSLMODE") or "require",
+    application_name=os.getenv("PG_APPLICATION_NAME", "iiko-etl-t1-light"),
+    connect_timeout=10,
+    # TCP keepalive: соединение из пула не отваливается молча, пока воркер ждёт OLAP от iiko
+    keepalives=1,
+    keepalives_idle=30,
+    keepalives_interval=10,
+    keepalives_count=3,
+)
+
+
+def iter_rows(conn, sql: str, params=None, itersize: int = 5000, name: str = "t1_light_stream"):
+    """
+    SELECT по T1_TARGET_TABLE (сверки, проверки) — через серверный курсор: строки приходят
+    пачками по itersize, а не всем результатом сразу в память libpq.
+    """
+    with conn.cursor(name=name) as cur:
+        cur.itersize = itersize
+        cur.execute(sql, params)
+        yield from cur
+
+
+def dump_json(obj) -> bytes:
+    """Тело запроса сразу в bytes: orjson сериализует быстрее stdlib и без лишнего прохода внутри requests."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def parse_json(resp):
+    """orjson парсит bytes напрямую — без декодирования в str и заметно быстрее stdlib json."""
+    if orjson is not None:
+        return orjson.loads(resp.content)
+    return resp.json()
 
-def get_pg_connection():
-    return psycopg2.connect(
-        host=os.getenv("PG_CRM_HOST"),
-        port=os.getenv("PG_CRM_PORT"),
-        dbname=os.getenv("PG_CRM_DB"),
-        user=os.getenv("PG_CRM_USER"),
-        password=os.getenv("PG_CRM_PASSWORD"),
-        sslmode=os.getenv("PG_CRM_SSLMODE", "require"),
-    )
 
+def get_pg_pool(workers: int) -> ThreadedConnectionPool:
+    # по соединению на поток-воркер, все открываются сразу и живут весь запуск:
+    # при minconn < maxconn putconn закрывает "лишние" — и параллельные чанки переподключаются заново
+    return ThreadedConnectionPool(workers, workers, PG_DSN)
+
+
+def getconn_alive(pool: ThreadedConnectionPool):
+    # соединение могло умереть, пока лежало в пуле (Neon усыпил compute, idle-таймаут сервера) —
+    # conn.closed этого не видит, поэтому дешёвая проба SELECT 1; не прошла — меняем на новое
+    conn = pool.getconn()
+    try:
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1;")
+        conn.rollback()
+    except psycopg2.Error:
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return conn
+
+
+def _load_cached_token():
+    try:
+        with open(IIKO_TOKEN_CACHE_FILE, encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # кэш валиден только для того же сервера и логина и пока не истёк
+    if cached.get("base_url") != IIKO_BASE_URL or cached.get("login") != IIKO_LOGIN:
+        return None
+    if cached.get("expires_at", 0) <= time.time():
+        return None
+    return cached.get("token")
+
+
+def _save_cached_token(token: str):
+    try:
+        # в файле — живой токен: только владельцу
+        fd = os.open(IIKO_TOKEN_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump(
+                {"base_url": IIKO_BASE_URL, "login": IIKO_LOGIN, "token": token, "expires_at": time.time() + IIKO_TOKEN_TTL_SEC},
+                f,
+            )
+    except OSError as e:
+        print("⚠️ Token cache write error:", e)
+
+
+def get_token(use_cache: bool = True) -> str:
+    """
+    Токен iiko. С IIKO_TOKEN_CACHE=1 сначала берём выданный прошлым запуском —
+    без лишнего round trip на /api/auth; если он уже не действует, первый OLAP получит 401
+    и token_ref-перевыпуск вызовет get_token(use_cache=False).
+    """
+    if IIKO_TOKEN_CACHE and use_cache:
+        token = _load_cached_token()
+        if token:
+            print(f"🔑 Token (cached): {token[:6]}...")
+            return token
 
-def get_token() -> str:
     url = f"{IIKO_BASE_URL}/api/auth"
     params = {"login": IIKO_LOGIN, "pass": IIKO_PASSWORD}
-    resp = requests.get(url, params=params, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    resp = _SESSION.get(url, params=params, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
     resp.raise_for_status()
     token = resp.text.strip()
     print(f"🔑 Token: {token[:6]}...")
+    if IIKO_TOKEN_CACHE:
+        _save_cached_token(token)
     return token
 
 
@@ -48,7 +284,7 @@ def logout(token: str):
     url = f"{IIKO_BASE_URL}/api/logout"
     params = {"key": token}
     try:
-        requests.post(url, params=params, timeout=(HTTP_CONNECT_TIMEOUT, 30))
+        _SESSION.post(url, params=params, timeout=(HTTP_CONNECT_TIMEOUT, 30))
     except Exception as e:
         print("⚠️ Logout error:", e)
 
@@ -70,221 +306,380 @@ def get_period():
     return d, d
 
 
-def week_chunks(date_from: dt.date, date_to: dt.date, chunk_days: int = 7):
+def iter_chunks(date_from: dt.date, date_to: dt.date, rate_ref: dict, chunk_days: int = 7):
     """
-    Режем на интервалы по N дней (по умолчанию 7).
-    date_to включительно.
-    Пример: 01-07, 08-14, ...
+    Режем период на интервалы (date_to включительно), следующий — по текущему указателю.
+    Первый чанк — chunk_days дней; дальше длина подбирается по rate_ref["rows_per_day"]
+    (обновляется по завершённым чанкам): ответ iiko держим около ROWS_PER_CHUNK_TARGET строк,
+    чтобы не упираться в read-таймаут на плотных неделях и не гонять лишние запросы на пустых.
     """
     if chunk_days <= 0:
         chunk_days = 7
 
-    chunks = []
     cur = date_from
     while cur <= date_to:
-        end = min(cur + dt.timedelta(days=chunk_days - 1), date_to)
-        chunks.append((cur, end))
+        days = chunk_days
+        rate = rate_ref.get("rows_per_day")
+        if ROWS_PER_CHUNK_TARGET > 0 and rate is not None:
+            days = MAX_CHUNK_DAYS if rate == 0 else max(1, min(MAX_CHUNK_DAYS, int(ROWS_PER_CHUNK_TARGET / rate)))
+        end = min(cur + dt.timedelta(days=days - 1), date_to)
+        yield cur, end
         cur = end + dt.timedelta(days=1)
-    return chunks
 
 
-def build_olap_body(date_from: dt.date, date_to: dt.date):
+def record_chunk_rate(rate_ref: dict, date_from: dt.date, date_to: dt.date, rows: int):
+    rate_ref["rows_per_day"] = rows / ((date_to - date_from).days + 1)
+
+
+# Всё тело OLAP-запроса, кроме периода, одинаково для всех чанков — собираем один раз при импорте
+_OLAP_BODY_STATIC = {
+    "reportType": "SALES",
+    "buildSummary": False,
+    "groupByRowFields": list(T1_LIGHT_FIELDS),
+    "aggregateFields": [],
+    "filters": {
+        "Storned": {"filterType": "IncludeValues", "values": ["FALSE"]},
+        "DeletedWithWriteoff": {"filterType": "IncludeValues", "values": ["NOT_DELETED"]},
+        "Department": {"filterType": "IncludeValues", "values": ["Авиагородок", "Домодедово"]},
+        "OrderDeleted": {"filterType": "IncludeValues", "values": ["NOT_DELETED"]},
+        "Delivery.CookingFinishTime": {"filterType": "ExcludeValues", "values": [None]},
+        "Delivery.Courier": {"filterType": "ExcludeValues", "values": [None, "Самовывоз"]},
+    },
+}
+
+
+def build_olap_body(date_from: dt.date, date_to: dt.date) -> dict:
+    # статичная часть общая (не копируется), новый только верхний dict и filters с периодом
     return {
-        "reportType": "SALES",
-        "buildSummary": False,
-        "groupByRowFields": [
-            "Delivery.CookingFinishTime",
-            "OpenTime",
-            "Delivery.PrintTime",
-            "Delivery.SendTime",
-            "Delivery.ActualTime",
-            "Delivery.CloseTime",
-            "Delivery.ExpectedTime",
-            "OpenDate.Typed",
-            "Delivery.SourceKey",
-            "Delivery.DeliveryComment",
-            "Department",
-            "Delivery.Region",
-            "Delivery.Number",
-            "Delivery.CustomerName",
-            "Delivery.Phone",
-            "Delivery.Address",
-            "Delivery.Courier",
-        ],
-        "aggregateFields": [],
+        **_OLAP_BODY_STATIC,
         "filters": {
             "OpenDate.Typed": {
                 "filterType": "DateRange",
                 "periodType": "CUSTOM",
-                "from": date_from.strftime("%Y-%m-%d"),
-                "to": date_to.strftime("%Y-%m-%d"),
+                "from": date_from.isoformat(),
+                "to": date_to.isoformat(),
                 "includeLow": True,
                 "includeHigh": True,
             },
-            "Storned": {"filterType": "IncludeValues", "values": ["FALSE"]},
-            "DeletedWithWriteoff": {"filterType": "IncludeValues", "values": ["NOT_DELETED"]},
-            "Department": {"filterType": "IncludeValues", "values": ["Авиагородок", "Домодедово"]},
-            "OrderDeleted": {"filterType": "IncludeValues", "values": ["NOT_DELETED"]},
-            "Delivery.CookingFinishTime": {"filterType": "ExcludeValues", "values": [None]},
-            "Delivery.Courier": {"filterType": "ExcludeValues", "values": [None, "Самовывоз"]},
+            **_OLAP_BODY_STATIC["filters"],
         },
     }
 
 
-def fetch_t1_light_with_token_refresh(token_ref: dict, date_from: dt.date, date_to: dt.date) -> dict:
+# Поля с парой десятков значений на весь ответ: подразделение, регион, курьер, источник заказа
+T1_LOW_CARDINALITY_FIELDS = ("Department", "Delivery.Region", "Delivery.Courier", "Delivery.SourceKey")
+
+
+def intern_low_cardinality(rows: list[dict]) -> list[dict]:
+    """
+    JSON-парсер создаёт отдельный str на каждое вхождение — "Авиагородок" в каждой строке свой.
+    Сводим повторы к одному объекту: ответ чанка лежит в очереди pipeline / ждёт COPY заметно компактнее.
+    """
+    intern = sys.intern
+    for r in rows:
+        for k in T1_LOW_CARDINALITY_FIELDS:
+            v = r.get(k)
+            if isinstance(v, str):
+                r[k] = intern(v)
+    return rows
+
+
+def backoff_delay(attempt: int) -> float:
+    # та же схема, что у _JitterRetry: HTTP_RETRY_SLEEP_SEC * 2^(attempt-1) (не больше 60с), разброс x0.5–1.5
+    return min(60, (2 ** (attempt - 1)) * HTTP_RETRY_SLEEP_SEC) * random.uniform(0.5, 1.5)
+
+
+def fetch_t1_light_with_token_refresh(token_ref: dict, date_from: dt.date, date_to: dt.date) -> Iterable[dict]:
     """
+    Строки OLAP (data[]) за период.
     token_ref = {"token": "..."} — чтобы можно было обновить токен внутри функции.
-    При 401 перевыпускаем токен и повторяем запрос.
+    При 401 перевыпускаем токен и повторяем запрос. Сетевые ошибки и 5xx повторяет сама сессия (urllib3 Retry).
+    При LOW_MEMORY=1 — ленивый итератор ijson по потоку ответа.
     """
+    if LOW_MEMORY and ijson is None:
+        raise RuntimeError("LOW_MEMORY=1 требует пакет ijson (pip install ijson)")
+
     url = f"{IIKO_BASE_URL}/api/v2/reports/olap"
 
-    body = build_olap_body(date_from, date_to)
+    # сериализуем один раз на чанк (а не на каждую попытку внутри requests)
+    body = dump_json(build_olap_body(date_from, date_to))
 
-    last_err = None
     for attempt in range(1, HTTP_RETRIES + 1):
         token = token_ref["token"]
         params = {"key": token}
+        print(f"📦 iiko OLAP request: {date_from} -> {date_to} (attempt {attempt}/{HTTP_RETRIES})")
         try:
-            print(f"📦 iiko OLAP request: {date_from} -> {date_to} (attempt {attempt}/{HTTP_RETRIES})")
-            resp = requests.post(
+            resp = _SESSION.post(
                 url,
                 params=params,
-                json=body,
+                data=body,
+                headers={"Content-Type": "application/json"},
                 timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+                stream=LOW_MEMORY,
             )
-
-            print("HTTP:", resp.status_code)
-
-            if resp.status_code == 401:
-                print("🔁 401 Unauthorized — token expired/invalid. Refresh token and retry chunk...")
-                try:
-                    logout(token)
-                except Exception:
-                    pass
-                token_ref["token"] = get_token()
-                # повторяем этот же attempt (без sleep)
-                continue
-
-            if resp.status_code >= 400:
-                print("iiko response (first 1000 chars):")
-                print(resp.text[:1000])
-
-            resp.raise_for_status()
-            return resp.json()
-
-        except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError) as e:
-            last_err = e
-            print(f"⏳ Network/timeout error: {e}")
-            if attempt < HTTP_RETRIES:
-                print(f"🔁 Sleep {HTTP_RETRY_SLEEP_SEC}s then retry...")
-                time.sleep(HTTP_RETRY_SLEEP_SEC)
-            else:
+        except requests.exceptions.ChunkedEncodingError as e:
+            # соединение оборвалось посреди тела ответа — это urllib3 Retry уже не повторяет
+            if attempt == HTTP_RETRIES:
                 raise
-        except Exception as e:
-            raise
+            delay = backoff_delay(attempt)
+            print(f"⏳ Broken response body: {e}. Retry in {delay:.1f}s...")
+            time.sleep(delay)
+            continue
+
+        print("HTTP:", resp.status_code, f"(encoding={resp.headers.get('Content-Encoding') or 'identity'})")
+
+        if resp.status_code == 401:
+            print("🔁 401 Unauthorized — token expired/invalid. Refresh token and retry chunk...")
+            # stream=True: тело не дочитано — закрываем, иначе соединение не вернётся в пул сессии
+            resp.close()
+            with _TOKEN_LOCK:
+                # другой поток мог уже перевыпустить токен — тогда просто повторяем с новым
+                if token_ref["token"] == token:
+                    try:
+                        logout(token)
+                    except Exception:
+                        pass
+                    token_ref["token"] = get_token(use_cache=False)
+            # повторяем запрос сразу (без sleep)
+            continue
+
+        if resp.status_code >= 400:
+            print("iiko response (first 1000 chars):")
+            print(resp.text[:1000])
+
+        resp.raise_for_status()
+
+        if LOW_MEMORY:
+            # raw-поток отдаём ijson, gzip распаковывает urllib3
+            resp.raw.decode_content = True
+            return ijson.items(resp.raw, "data.item", use_float=True)
+        return intern_low_cardinality(parse_json(resp).get("data", []))
+
+    raise RuntimeError(f"iiko OLAP {date_from} -> {date_to}: no successful response after {HTTP_RETRIES} attempts")
+
+
+class GenIO:
+    """
+    Файлоподобная обёртка над генератором bytes: copy_expert читает из неё кусками через read(n),
+    поэтому весь COPY-поток целиком в памяти не собирается.
+    """
 
-    raise last_err
+    def __init__(self, gen):
+        self.gen = gen
+        self.buf = b""
 
+    def read(self, n: int = -1) -> bytes:
+        while n < 0 or len(self.buf) < n:
+            try:
+                self.buf += next(self.gen)
+            except StopIteration:
+                break
+        if n < 0:
+            out, self.buf = self.buf, b""
+        else:
+            out, self.buf = self.buf[:n], self.buf[n:]
+        return out
 
-def upsert_t1_light(data: dict):
-    rows = data.get("data", [])
-    print(f"📊 Rows received: {len(rows)}")
-    if not rows:
-        print("⚠️ No data to write.")
-        return
 
-    conn = get_pg_connection()
-    cur = conn.cursor()
-
-    query = """
-    INSERT INTO crm.iiko_t1_light (
-        delivery_cooking_finish_time,
-        open_time,
-        delivery_print_time,
-        delivery_send_time,
-        delivery_actual_time,
-        delivery_close_time,
-        delivery_expected_time,
-        open_date,
-        delivery_source_key,
-        delivery_comment,
-        department,
-        delivery_region,
-        delivery_number,
-        delivery_customer_name,
-        delivery_phone,
-        delivery_address,
-        delivery_courier,
-        updated_at
-    )
-    VALUES (
-        %(Delivery.CookingFinishTime)s,
-        %(OpenTime)s,
-        %(Delivery.PrintTime)s,
-        %(Delivery.SendTime)s,
-        %(Delivery.ActualTime)s,
-        %(Delivery.CloseTime)s,
-        %(Delivery.ExpectedTime)s,
-        %(OpenDate.Typed)s,
-        %(Delivery.SourceKey)s,
-        %(Delivery.DeliveryComment)s,
-        %(Department)s,
-        %(Delivery.Region)s,
-        %(Delivery.Number)s,
-        %(Delivery.CustomerName)s,
-        %(Delivery.Phone)s,
-        %(Delivery.Address)s,
-        %(Delivery.Courier)s,
-        now()
-    )
-    ON CONFLICT (department, delivery_cooking_finish_time, delivery_number)
+# Все 17 полей строки OLAP одним C-вызовом, в порядке T1_LIGHT_FIELDS (iiko отдаёт каждое поле группировки, null — как null)
+_T1_ROW_GETTER = itemgetter(*T1_LIGHT_FIELDS)
+
+
+def iter_stage_csv(rows: Iterable[dict], flush_bytes: int = 1 << 16):
+    """
+    Строки OLAP -> поток COPY (FORMAT csv) пачками по ~64KB: поля в порядке T1_LIGHT_FIELDS + порядковый номер.
+    None -> \\N (NULL), пустая строка остаётся пустой строкой.
+    """
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    for i, r in enumerate(rows):
+        w.writerow([r"\N" if v is None else v for v in _T1_ROW_GETTER(r)] + [i])
+        if buf.tell() >= flush_bytes:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+def upsert_t1_light(conn, rows: Iterable[dict]):
+    cols_sql = ", ".join(T1_LIGHT_COLS)
+    key_sql = ", ".join(T1_LIGHT_KEY_COLS)
+    update_sql = ",\n        ".join(f"{c} = EXCLUDED.{c}" for c in T1_LIGHT_COLS if c not in T1_LIGHT_KEY_COLS)
+
+    # Staging без ограничений целевой таблицы, но с её типами; ON COMMIT DROP — убирается сама.
+    # ord — порядок строки в ответе iiko, нужен для схлопывания дублей ключа
+    create_stage_sql = f"""
+    CREATE TEMP TABLE {T1_STAGE_TABLE} ON COMMIT DROP AS
+    SELECT {cols_sql}, 0::bigint AS ord FROM {T1_TARGET_TABLE} WITH NO DATA;
+    """
+
+    # Один set-based upsert из staging вместо построчного ON CONFLICT.
+    # Один ключ в одном INSERT ... SELECT дважды нельзя (ON CONFLICT не обновляет строку повторно) —
+    # DISTINCT ON оставляет последнюю строку ключа, как и при построчной вставке
+    query = f"""
+    INSERT INTO {T1_TARGET_TABLE} ({cols_sql}, updated_at)
+    SELECT DISTINCT ON ({key_sql}) {cols_sql}, now()
+    FROM {T1_STAGE_TABLE}
+    ORDER BY {key_sql}, ord DESC
+    ON CONFLICT ({key_sql})
     DO UPDATE SET
-        open_time = EXCLUDED.open_time,
-        delivery_print_time = EXCLUDED.delivery_print_time,
-        delivery_send_time = EXCLUDED.delivery_send_time,
-        delivery_actual_time = EXCLUDED.delivery_actual_time,
-        delivery_close_time = EXCLUDED.delivery_close_time,
-        delivery_expected_time = EXCLUDED.delivery_expected_time,
-        open_date = EXCLUDED.open_date,
-        delivery_source_key = EXCLUDED.delivery_source_key,
-        delivery_comment = EXCLUDED.delivery_comment,
-        delivery_region = EXCLUDED.delivery_region,
-        delivery_customer_name = EXCLUDED.delivery_customer_name,
-        delivery_phone = EXCLUDED.delivery_phone,
-        delivery_address = EXCLUDED.delivery_address,
-        delivery_courier = EXCLUDED.delivery_courier,
+        {update_sql},
         updated_at = now();
     """
 
-    for row in rows:
-        cur.execute(query, row)
+    copied = 0
+
+    def counted(it):
+        nonlocal copied
+        for r in it:
+            copied += 1
+            yield r
 
-    conn.commit()
-    cur.close()
-    conn.close()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(create_stage_sql)
+            # при LOW_MEMORY строки читаются из HTTP-ответа прямо во время COPY
+            cur.copy_expert(
+                f"COPY {T1_STAGE_TABLE} ({cols_sql}, ord) FROM STDIN WITH (FORMAT csv, NULL '\\N', ENCODING 'UTF8')",
+                GenIO(iter_stage_csv(counted(rows))),
+            )
+            print(f"📊 Rows received: {copied}")
+            if copied == 0:
+                conn.rollback()
+                print("⚠️ No data to write.")
+                return 0
+            cur.execute(query)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
     print("✅ Upsert done")
+    return copied
+
+
+def iter_chunks_pipelined(token_ref: dict, chunks: Iterable[tuple[dt.date, dt.date]]):
+    """
+    Producer/consumer для одного потока-воркера: fetch следующего чанка идёт в отдельном потоке,
+    пока текущий пишется в Postgres. Очередь на 2 ответа — больше в памяти не держим.
+    При LOW_MEMORY=1 наперёд не запрашиваем: ответ — открытый поток, и пока ждёт за COPY
+    текущего чанка, может упасть по read-таймауту. Следующий запрос — только когда
+    поток предыдущего вычитан (генератор продолжается после upsert).
+    """
+    if LOW_MEMORY:
+        for d1, d2 in chunks:
+            yield d1, d2, fetch_t1_light_with_token_refresh(token_ref, d1, d2)
+        return
+
+    q = queue.Queue(maxsize=2)
+
+    def produce():
+        try:
+            for d1, d2 in chunks:
+                q.put((d1, d2, fetch_t1_light_with_token_refresh(token_ref, d1, d2)))
+            q.put(None)
+        except BaseException as e:
+            q.put(e)
+
+    threading.Thread(target=produce, name="t1-light-fetch", daemon=True).start()
+
+    while True:
+        item = q.get()
+        if item is None:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+def process_chunk(token_ref: dict, pool: ThreadedConnectionPool, date_from: dt.date, date_to: dt.date):
+    rows = fetch_t1_light_with_token_refresh(token_ref, date_from, date_to)
+    conn = getconn_alive(pool)
+    try:
+        return upsert_t1_light(conn, rows)
+    finally:
+        pool.putconn(conn)
+
+
+def run_chunks(token_ref: dict, pool: ThreadedConnectionPool, chunks, rate_ref: dict, workers: int):
+    if workers == 1:
+        # T1_WORKERS=1 (например, iiko не держит параллельные OLAP): запросы по одному,
+        # но upsert чанка идёт одновременно с запросом следующего (кроме LOW_MEMORY)
+        conn = getconn_alive(pool)
+        try:
+            for i, (d1, d2, rows) in enumerate(iter_chunks_pipelined(token_ref, chunks), 1):
+                n = upsert_t1_light(conn, rows)
+                record_chunk_rate(rate_ref, d1, d2, n)
+                print(f"=== Chunk {i} done: {d1} -> {d2} ({n} rows) ===")
+        finally:
+            pool.putconn(conn)
+        return
+
+    # Чанки независимы: пока один ждёт OLAP от iiko, другой уже пишет в Postgres.
+    # Следующий чанк отдаём воркеру только когда освободился предыдущий — к этому моменту
+    # плотность уже пересчитана по завершённому чанку
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        futures = {ex.submit(process_chunk, token_ref, pool, d1, d2): (d1, d2) for d1, d2 in islice(chunks, workers)}
+        i = 0
+        try:
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    d1, d2 = futures.pop(fut)
+                    n = fut.result()
+                    record_chunk_rate(rate_ref, d1, d2, n)
+                    i += 1
+                    print(f"=== Chunk {i} done: {d1} -> {d2} ({n} rows) ===")
+                    nxt = next(chunks, None)
+                    if nxt is not None:
+                        futures[ex.submit(process_chunk, token_ref, pool, *nxt)] = nxt
+        except Exception:
+            # не начинаем оставшиеся чанки, если один упал
+            for f in futures:
+                f.cancel()
+            raise
 
 
 def main():
     date_from, date_to = get_period()
-    print(f"🚀 ETL TI Light (CRM): {date_from} -> {date_to}")
+    print(f"🚀 ETL TI Light -> {T1_TARGET_TABLE}: {date_from} -> {date_to}")
+
+    rate_ref = {"rows_per_day": None}
+    chunks = iter_chunks(date_from, date_to, rate_ref, chunk_days=CHUNK_DAYS)
+    # больше воркеров, чем чанков по CHUNK_DAYS, не понадобится
+    max_chunks = -(-((date_to - date_from).days + 1) // max(CHUNK_DAYS, 1))
+    workers = max(1, min(T1_WORKERS, max_chunks))
+    print(f"🧩 Chunks: adaptive (first chunk_days={CHUNK_DAYS}, target rows={ROWS_PER_CHUNK_TARGET}, workers={workers})")
+
+    # auth в iiko и первое соединение с Postgres (TLS до Neon) независимы — делаем параллельно
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        fut_token = ex.submit(get_token)
+        fut_pool = ex.submit(get_pg_pool, workers)
 
-    token_ref = {"token": get_token()}
     try:
-        chunks = week_chunks(date_from, date_to, chunk_days=CHUNK_DAYS) if date_from != date_to else [(date_from, date_to)]
-        print(f"🧩 Chunks: {len(chunks)} (chunk_days={CHUNK_DAYS})")
+        token_ref = {"token": fut_token.result()}
+    except Exception:
+        if fut_pool.exception() is None:
+            fut_pool.result().closeall()
+        raise
 
-        for i, (d1, d2) in enumerate(chunks, 1):
-            print(f"\n=== Chunk {i}/{len(chunks)}: {d1} -> {d2} ===")
-            data = fetch_t1_light_with_token_refresh(token_ref, d1, d2)
-            upsert_t1_light(data)
+    try:
+        pool = fut_pool.result()
+        try:
+            run_chunks(token_ref, pool, chunks, rate_ref, workers)
+        finally:
+            pool.closeall()
 
     finally:
-        try:
-            logout(token_ref["token"])
-        except Exception:
-            pass
-        print("🔐 Logout done")
+        if IIKO_TOKEN_CACHE:
+            # токен остаётся живым до истечения кэша — его подхватит следующий запуск
+            print("🔐 Token kept for the next run (IIKO_TOKEN_CACHE)")
+        else:
+            try:
+                logout(token_ref["token"])
+            except Exception:
+                pass
+            print("🔐 Logout done")
 
 
 if __name__ == "__main__":